@@ -1,31 +1,101 @@
+# Fast inner loop for OPTICS.
+# Authors: Shane Grigsby <refuge@rocktalus.com>
+#          Amy X. Zhang <axz@mit.edu>
+# License: BSD 3 clause
+
+cimport cython
 cimport numpy as np
 import numpy as np
-cimport cython
 
-ctypedef np.float64_t DTYPE_t
-ctypedef np.int_t DTYPE
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-# Checks for smallest reachability distance
-# In case of tie, preserves order and returns first instance
-# as sorted by distance
-cpdef quick_scan(double[:] rdists, double[:] dists):
-    cdef Py_ssize_t n
-    cdef int idx
-    cdef int i
-    cdef double rdist
-    cdef double dist
-    rdist = np.inf
-    dist = np.inf
-    n = len(rdists)
-    for i from 0 <= i < n:
-        if rdists[i] < rdist:
-            rdist = rdists[i]
-            dist = dists[i]
-            idx = i
-        if rdists[i] == rdist:
-            if dists[i] < dist:
-                dist = dists[i]
-                idx = i
-    return idx
+def compute_optics_order(np.ndarray[np.npy_intp, ndim=1, mode='c'] nb_offsets,
+                         np.ndarray[np.npy_intp, ndim=1, mode='c'] nb_indices,
+                         np.ndarray[np.float64_t, ndim=1,
+                                    mode='c'] nb_dists,
+                         np.ndarray[np.float64_t, ndim=1,
+                                    mode='c'] core_distances,
+                         np.ndarray[np.float64_t, ndim=1,
+                                    mode='c'] reachability,
+                         np.ndarray[np.uint8_t, ndim=1, mode='c'] processed,
+                         np.ndarray[np.npy_intp, ndim=1, mode='c'] ordering,
+                         double max_bound):
+    """Compute the OPTICS ordering from precomputed neighborhoods.
+
+    Neighborhoods are given in CSR-like form: the neighbors of point ``p``
+    are ``nb_indices[nb_offsets[p]:nb_offsets[p + 1]]``, with matching
+    distances in ``nb_dists``. ``reachability`` and ``processed`` are
+    updated in place, and ``ordering`` is filled with the cluster ordering.
+
+    The expansion loop is not parallelizable; the order that entries are
+    written to ``ordering`` is important. When several unprocessed
+    neighbors tie on reachability, the one closest to the current point
+    is expanded first; in case of further ties the first instance wins.
+    """
+    cdef np.npy_intp n = core_distances.shape[0]
+    cdef np.npy_intp ordering_idx = 0
+    cdef np.npy_intp start, point, best, i, j
+    cdef double core_dist, dist, rdist, reach, best_reach, best_dist
+    cdef double infinity = np.inf
+    # Number of unprocessed points left in each neighborhood. Since the
+    # neighbor relation is symmetric, decrementing the counts of every
+    # neighbor of a point as it is processed keeps remaining[p] equal to
+    # the number of unprocessed neighbors of p, letting exhausted
+    # neighborhoods skip their scan entirely.
+    cdef np.ndarray[np.npy_intp, ndim=1] remaining = np.diff(nb_offsets)
+
+    for start in range(n):
+        if processed[start]:
+            continue
+        if core_distances[start] > max_bound:
+            # Too noisy to seed an expansion; enters the ordering alone
+            processed[start] = 1
+            ordering[ordering_idx] = start
+            ordering_idx += 1
+            for j in range(nb_offsets[start], nb_offsets[start + 1]):
+                remaining[nb_indices[j]] -= 1
+            continue
+
+        point = start
+        while not processed[point]:
+            processed[point] = 1
+            ordering[ordering_idx] = point
+            ordering_idx += 1
+            for j in range(nb_offsets[point], nb_offsets[point + 1]):
+                remaining[nb_indices[j]] -= 1
+
+            if remaining[point] == 0:
+                # Nothing unprocessed left around this point; the scan
+                # below could not find a successor, so close the
+                # expansion without walking the neighborhood
+                break
+
+            core_dist = core_distances[point]
+            best = point
+            best_reach = infinity
+            best_dist = infinity
+            for j in range(nb_offsets[point], nb_offsets[point + 1]):
+                i = nb_indices[j]
+                if processed[i]:
+                    continue
+                # Work on scalar locals so each slot of nb_dists and
+                # reachability is loaded at most once per neighbor
+                dist = nb_dists[j]
+                rdist = dist
+                if rdist < core_dist:
+                    rdist = core_dist
+                reach = reachability[i]
+                if rdist < reach:
+                    reach = rdist
+                    reachability[i] = rdist
+                # Track the unprocessed neighbor with the smallest
+                # reachability, breaking ties by distance
+                if reach < best_reach:
+                    best_reach = reach
+                    best_dist = dist
+                    best = i
+                elif reach == best_reach and dist < best_dist:
+                    best_dist = dist
+                    best = i
+            point = best
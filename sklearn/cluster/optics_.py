@@ -12,12 +12,14 @@ License: BSD 3 clause
 import warnings
 import numpy as np
 
-from ..utils import check_array
-from ..utils.validation import check_is_fitted
+from scipy.ndimage import maximum_filter
+
+from ..utils import check_array, _get_n_jobs, gen_even_slices
+from ..utils.validation import check_is_fitted, check_memory
 from ..neighbors import NearestNeighbors
 from ..base import BaseEstimator, ClusterMixin
-from ..metrics.pairwise import pairwise_distances
-from ._optics_inner import quick_scan
+from ..externals.joblib import Parallel, delayed
+from ._optics_inner import compute_optics_order
 
 
 def optics(X, min_samples=5, max_bound=np.inf, metric='euclidean',
@@ -25,7 +27,7 @@ def optics(X, min_samples=5, max_bound=np.inf, metric='euclidean',
            rejection_ratio=.7, similarity_threshold=0.4,
            significant_min=.003, min_cluster_size_ratio=.005,
            min_maxima_ratio=0.001, algorithm='ball_tree',
-           leaf_size=30, n_jobs=1):
+           leaf_size=30, n_jobs=1, memory=None):
     """Perform OPTICS clustering from vector array
 
     OPTICS: Ordering Points To Identify the Clustering Structure
@@ -47,7 +49,10 @@ def optics(X, min_samples=5, max_bound=np.inf, metric='euclidean',
         as in the same neighborhood. This is also the largest object size
         expected within the dataset. Default value of "np.inf" will identify
         clusters across all scales; reducing `max_bound` will result in
-        shorter run times.
+        shorter run times. All neighborhoods within `max_bound` are
+        precomputed and held in memory at once, so memory consumption
+        scales with their total size and is quadratic in the number of
+        samples at large `max_bound`; reduce it for large datasets.
 
     metric : string or callable, optional
         The distance metric to use for neighborhood lookups. Default is
@@ -119,6 +124,13 @@ def optics(X, min_samples=5, max_bound=np.inf, metric='euclidean',
         If ``-1``, then the number of jobs is set to the number of CPU cores.
         Affects only :meth:`kneighbors` and :meth:`kneighbors_graph` methods.
 
+    memory : None, str or object with the joblib.Memory interface, optional
+        Used to cache the output of the computation of the core distances
+        and neighborhoods, which does not depend on the extraction
+        parameters. By default, no caching is done. If a string is given,
+        it is the path to the caching directory. The cached arrays grow
+        with the total neighborhood size, like the in-memory footprint.
+
     Returns
     -------
     core_sample_indices_ : array, shape (n_core_samples,)
@@ -138,7 +150,7 @@ def optics(X, min_samples=5, max_bound=np.inf, metric='euclidean',
                    maxima_ratio, rejection_ratio,
                    similarity_threshold, significant_min,
                    min_cluster_size_ratio, min_maxima_ratio,
-                   algorithm, leaf_size, n_jobs)
+                   algorithm, leaf_size, n_jobs, memory)
     clust.fit(X)
     return clust.core_sample_indices_, clust.labels_
 
@@ -162,7 +174,10 @@ class OPTICS(BaseEstimator, ClusterMixin):
         as in the same neighborhood. This is also the largest object size
         expected within the dataset. Default value of "np.inf" will identify
         clusters across all scales; reducing `max_bound` will result in
-        shorter run times.
+        shorter run times. All neighborhoods within `max_bound` are
+        precomputed and held in memory at once, so memory consumption
+        scales with their total size and is quadratic in the number of
+        samples at large `max_bound`; reduce it for large datasets.
 
     metric : string or callable, optional
         The distance metric to use for neighborhood lookups. Default is
@@ -234,6 +249,13 @@ class OPTICS(BaseEstimator, ClusterMixin):
         If ``-1``, then the number of jobs is set to the number of CPU cores.
         Affects only :meth:`kneighbors` and :meth:`kneighbors_graph` methods.
 
+    memory : None, str or object with the joblib.Memory interface, optional
+        Used to cache the output of the computation of the core distances
+        and neighborhoods, which does not depend on the extraction
+        parameters. By default, no caching is done. If a string is given,
+        it is the path to the caching directory. The cached arrays grow
+        with the total neighborhood size, like the in-memory footprint.
+
     Attributes
     ----------
     core_sample_indices_ : array, shape (n_core_samples,)
@@ -275,7 +297,7 @@ class OPTICS(BaseEstimator, ClusterMixin):
                  rejection_ratio=.7, similarity_threshold=0.4,
                  significant_min=.003, min_cluster_size_ratio=.005,
                  min_maxima_ratio=0.001, algorithm='ball_tree',
-                 leaf_size=30, n_jobs=1):
+                 leaf_size=30, n_jobs=1, memory=None):
 
         self.max_bound = max_bound
         self.min_samples = min_samples
@@ -291,6 +313,7 @@ class OPTICS(BaseEstimator, ClusterMixin):
         self.p = p
         self.leaf_size = leaf_size
         self.n_jobs = n_jobs
+        self.memory = memory
 
     def fit(self, X, y=None):
         """Perform OPTICS clustering
@@ -311,43 +334,59 @@ class OPTICS(BaseEstimator, ClusterMixin):
         self : instance of OPTICS
             The instance.
         """
-        X = check_array(X, dtype=np.float)
+        X = check_array(X, dtype=np.float64)
 
         n_samples = len(X)
-        # Start all points as 'unprocessed' ##
-        self._processed = np.zeros((n_samples, 1), dtype=bool)
-        self.reachability_ = np.ones(n_samples) * np.inf
-        self.core_distances_ = np.ones(n_samples) * np.nan
-        # Start all points as noise ##
-        self.labels_ = -np.ones(n_samples, dtype=int)
-        self.ordering_ = []
+        min_samples = self.min_samples
+        max_bound = self.max_bound
+
+        # All arrays are built in locals and bound to the estimator once;
+        # everything below, including the Cython main loop, works on the
+        # local references
+        # Start all points as 'unprocessed'; stored as uint8 so the
+        # Cython main loop can test the flags without reinterpreting
+        # the buffer ##
+        processed = np.zeros(n_samples, dtype=np.uint8)
+        reachability = np.full(n_samples, np.inf)
+        # Preallocated; every point enters the ordering exactly once
+        ordering = np.empty(n_samples, dtype=np.intp)
 
         # Check for valid n_samples relative to min_samples
-        if self.min_samples > n_samples:
+        if min_samples > n_samples:
             raise ValueError("Number of training samples (n_samples=%d) must "
                              "be greater than min_samples (min_samples=%d) "
                              "used for clustering." %
-                             (n_samples, self.min_samples))
-
-        nbrs = NearestNeighbors(n_neighbors=self.min_samples,
-                                algorithm=self.algorithm,
-                                leaf_size=self.leaf_size, metric=self.metric,
-                                metric_params=self.metric_params, p=self.p,
-                                n_jobs=self.n_jobs)
-
-        nbrs.fit(X)
-        self.core_distances_[:] = nbrs.kneighbors(X,
-                                                  self.min_samples)[0][:, -1]
-        self._nbrs = nbrs
+                             (n_samples, min_samples))
+
+        # The tree build and batched queries do not depend on the
+        # extraction parameters, so they can be cached across repeated
+        # fits (e.g. a grid search over extraction epsilons)
+        # The helper's outputs are bound directly rather than copied into
+        # preallocated arrays; they are freshly allocated (or memmapped
+        # from the cache) and owned by this estimator alone
+        memory = check_memory(self.memory)
+        core_distances, nb_offsets, nb_indices, nb_dists = memory.cache(
+            _compute_neighborhoods)(X, min_samples, max_bound, self.metric,
+                                    self.p, self.metric_params,
+                                    self.algorithm, self.leaf_size,
+                                    self.n_jobs)
 
         # Main OPTICS loop. Not parallelizable. The order that entries are
-        # written to the 'ordering_' list is important!
-        for point in range(n_samples):
-            if not self._processed[point]:
-                self._expand_cluster_order(point, X)
-
-        indices_, self.labels_ = _extract_optics(self.ordering_,
-                                                 self.reachability_,
+        # written to the 'ordering' array is important!
+        compute_optics_order(nb_offsets, nb_indices, nb_dists,
+                             core_distances, reachability, processed,
+                             ordering, max_bound)
+
+        # The CSR neighborhood arrays are deliberately not bound to the
+        # estimator: nothing reads them after the ordering is computed,
+        # and at large max_bound they are quadratic in n_samples
+        self._processed = processed
+        self.reachability_ = reachability
+        self.core_distances_ = core_distances
+        self.ordering_ = ordering
+
+        indices_, self.labels_ = _extract_optics(ordering,
+                                                 reachability,
                                                  self.maxima_ratio,
                                                  self.rejection_ratio,
                                                  self.similarity_threshold,
@@ -355,49 +394,9 @@ class OPTICS(BaseEstimator, ClusterMixin):
                                                  self.min_cluster_size_ratio,
                                                  self.min_maxima_ratio)
         self.core_sample_indices_ = indices_
-        self.n_clusters_ = np.max(self.labels_)
+        self.n_clusters_ = int(self.labels_.max())
         return self
 
-    # OPTICS helper functions; these should not be public #
-
-    def _expand_cluster_order(self, point, X):
-        # As above, not parallelizable. Parallelizing would allow items in
-        # the 'unprocessed' list to switch to 'processed'
-        if self.core_distances_[point] <= self.max_bound:
-            while not self._processed[point]:
-                self._processed[point] = True
-                self.ordering_.append(point)
-                point = self._set_reach_dist(point, X)
-        else:  # For very noisy points
-            self.ordering_.append(point)
-            self._processed[point] = True
-
-    def _set_reach_dist(self, point_index, X):
-        P = np.array(X[point_index]).reshape(1, -1)
-        indices = self._nbrs.radius_neighbors(P, radius=self.max_bound,
-                                              return_distance=False)[0]
-
-        # Getting indices of neighbors that have not been processed
-        unproc = np.compress((~np.take(self._processed, indices)).ravel(),
-                             indices, axis=0)
-        # Keep n_jobs = 1 in the following lines...please
-        if len(unproc) > 0:
-            dists = pairwise_distances(P, np.take(X, unproc, axis=0),
-                                       self.metric, n_jobs=1).ravel()
-
-            rdists = np.maximum(dists, self.core_distances_[point_index])
-            new_reach = np.minimum(np.take(self.reachability_, unproc), rdists)
-            self.reachability_[unproc] = new_reach
-
-        # Checks to see if everything is already processed;
-        # if so, return control to main loop
-        if unproc.size > 0:
-            # Define return order based on reachability distance
-            return(unproc[quick_scan(np.take(self.reachability_, unproc),
-                                     dists)])
-        else:
-            return point_index
-
     def extract_dbscan(self, eps):
         """Performs DBSCAN extraction for an arbitrary epsilon.
 
@@ -438,6 +437,78 @@ class OPTICS(BaseEstimator, ClusterMixin):
                                self.reachability_, eps)
 
 
+def _compute_neighborhoods(X, min_samples, max_bound, metric, p,
+                           metric_params, algorithm, leaf_size, n_jobs):
+    """Compute core distances and `max_bound` neighborhoods for OPTICS.
+
+    This is the expensive part of :meth:`OPTICS.fit` that does not depend
+    on the extraction parameters; keeping it a function of plain
+    arguments allows it to be cached with :class:`joblib.Memory`.
+
+    Parameters are as documented for :class:`OPTICS`.
+
+    The neighborhoods are returned in CSR-like form -- flat contiguous
+    arrays instead of one small ndarray per point -- which is the layout
+    the Cython main loop consumes and also what :class:`joblib.Memory`
+    persists and memmaps efficiently.
+
+    Returns
+    -------
+    core_distances : array, shape (n_samples,)
+        Distance at which each sample becomes a core point.
+    nb_offsets : array, shape (n_samples + 1,)
+        Offsets into `nb_indices`/`nb_dists`; the neighbors of point p
+        are ``nb_indices[nb_offsets[p]:nb_offsets[p + 1]]``.
+    nb_indices : array, shape (n_neighbor_pairs,)
+        Flattened indices of the neighbors within `max_bound`.
+    nb_dists : array, shape (n_neighbor_pairs,)
+        Flattened distances to the neighbors within `max_bound`.
+    """
+    n_samples = X.shape[0]
+    nbrs = NearestNeighbors(n_neighbors=min_samples, algorithm=algorithm,
+                            leaf_size=leaf_size, metric=metric,
+                            metric_params=metric_params, p=p, n_jobs=n_jobs)
+    nbrs.fit(X)
+    # The last column of the k-NN distances; made contiguous since the
+    # Cython main loop requires a C-ordered buffer
+    core_distances = np.ascontiguousarray(
+        nbrs.kneighbors(X, min_samples)[0][:, -1])
+
+    # A single batched query collects every neighborhood in one pass;
+    # the main loop only ever reads these cached arrays instead of
+    # issuing one tree traversal per point. For tree-based methods the
+    # tree is queried directly, skipping a second validation of X;
+    # neither BallTree nor KDTree exposes a dual-tree mode for radius
+    # queries (only for k-NN), so the batched single-tree traversal is
+    # the fastest available bulk form.
+    if nbrs._fit_method in ('ball_tree', 'kd_tree'):
+        # The tree descents are independent across query points, so the
+        # bulk query is split into even chunks and run with the threading
+        # backend; query_radius releases the GIL. Chunks come back in
+        # slice order, so concatenating preserves the input order.
+        n_jobs = _get_n_jobs(n_jobs)
+        results = Parallel(n_jobs, backend='threading')(
+            delayed(nbrs._tree.query_radius, check_pickle=False)(
+                X[s], max_bound, return_distance=True)
+            for s in gen_even_slices(n_samples, n_jobs))
+        neighbor_indices, neighbor_dists = tuple(zip(*results))
+        neighbor_indices = np.concatenate(neighbor_indices)
+        neighbor_dists = np.concatenate(neighbor_dists)
+    else:
+        neighbor_dists, neighbor_indices = nbrs.radius_neighbors(
+            X, radius=max_bound, return_distance=True)
+
+    neighbor_sizes = np.fromiter((ind.size for ind in neighbor_indices),
+                                 dtype=np.intp, count=n_samples)
+    nb_offsets = np.zeros(n_samples + 1, dtype=np.intp)
+    np.cumsum(neighbor_sizes, out=nb_offsets[1:])
+    nb_indices = np.ascontiguousarray(
+        np.concatenate(neighbor_indices), dtype=np.intp)
+    nb_dists = np.ascontiguousarray(
+        np.concatenate(neighbor_dists), dtype=np.float64)
+    return core_distances, nb_offsets, nb_indices, nb_dists
+
+
 def _extract_dbscan(ordering, core_distances, reachability, eps):
     """Performs DBSCAN extraction for an arbitrary epsilon (`eps`).
 
@@ -462,26 +533,21 @@ def _extract_dbscan(ordering, core_distances, reachability, eps):
     """
 
     n_samples = len(core_distances)
+    reach = reachability[ordering]
+    core = core_distances[ordering]
+
+    far_reach = reach > eps
+    near_core = core <= eps
+    # Unreachable core points start a new cluster; counting them with a
+    # cumulative sum assigns cluster ids along the ordering in a single
+    # vectorized pass over the arrays.
+    labels_ordered = np.cumsum(far_reach & near_core)
+    labels_ordered[far_reach & ~near_core] = -1   # Noise points
+    labels = np.empty(n_samples, dtype=int)
+    labels[ordering] = labels_ordered
     is_core = np.zeros(n_samples, dtype=bool)
-    labels = np.ones(n_samples, dtype=int) * -1
-    cluster_id = 0
-
-    for entry in ordering:
-        if reachability[entry] > eps:
-            if core_distances[entry] <= eps:
-                cluster_id += 1
-                labels[entry] = cluster_id
-            else:
-                # This is only needed for compatibility for repeated scans.
-                labels[entry] = -1   # Noise points
-                is_core[entry] = 0
-        else:
-            labels[entry] = cluster_id
-            if core_distances[entry] <= eps:
-                is_core[entry] = 1   # True
-            else:
-                is_core[entry] = 0   # False
-    return np.arange(n_samples)[is_core], labels
+    is_core[ordering[~far_reach & near_core]] = True
+    return np.flatnonzero(is_core), labels
 
 
 def _extract_optics(ordering, reachability, maxima_ratio=.75,
@@ -540,7 +606,7 @@ def _extract_optics(ordering, reachability, maxima_ratio=.75,
     """
 
     # Extraction wrapper
-    reachability_plot = reachability[ordering].tolist()
+    reachability_plot = reachability[ordering]
     root_node = _automatic_cluster(reachability_plot, ordering,
                                    maxima_ratio, rejection_ratio,
                                    similarity_threshold, significant_min,
@@ -550,14 +616,14 @@ def _extract_optics(ordering, reachability, maxima_ratio=.75,
     clustid = 0
     n_samples = len(reachability)
     is_core = np.zeros(n_samples, dtype=bool)
-    labels = np.ones(n_samples, dtype=int) * -1
+    labels = np.full(n_samples, -1, dtype=int)
     # Start all points as non-core noise
     for leaf in leaves:
         index = ordering[leaf.start:leaf.end]
         labels[index] = clustid
         is_core[index] = 1
         clustid += 1
-    return np.arange(n_samples)[is_core], labels
+    return np.flatnonzero(is_core), labels
 
 
 def _automatic_cluster(reachability_plot, reachability_ordering,
@@ -580,12 +646,10 @@ def _automatic_cluster(reachability_plot, reachability_ordering,
         neighborhood_size = min_neighborhood_size
 
     local_maxima_points = _find_local_maxima(reachability_plot,
-                                             reachability_ordering,
                                              neighborhood_size)
-    root_node = _TreeNode(reachability_ordering, 0,
-                          len(reachability_ordering), None)
+    root_node = _TreeNode(0, len(reachability_ordering), None)
     _cluster_tree(root_node, None, local_maxima_points,
-                  reachability_plot, reachability_ordering, min_cluster_size,
+                  reachability_plot, min_cluster_size,
                   maxima_ratio, rejection_ratio,
                   similarity_threshold, significant_min)
 
@@ -593,9 +657,10 @@ def _automatic_cluster(reachability_plot, reachability_ordering,
 
 
 class _TreeNode(object):
-    # automatic cluster helper classes and functions
-    def __init__(self, points, start, end, parent_node):
-        self.points = points
+    # automatic cluster helper classes and functions; nodes only carry
+    # their [start, end) range on the reachability plot, never a copy of
+    # the points themselves
+    def __init__(self, start, end, parent_node):
         self.start = start
         self.end = end
         self.parent_node = parent_node
@@ -609,166 +674,157 @@ class _TreeNode(object):
         self.children.append(child)
 
 
-def _is_local_maxima(index, reachability_plot, reachability_ordering,
-                     neighborhood_size):
-    # 0 = point at index is not local maxima
-    # 1 = point at index is local maxima
-    for i in range(1, neighborhood_size + 1):
-        # process objects to the right of index
-        if index + i < len(reachability_plot):
-            if (reachability_plot[index] < reachability_plot[index + i]):
-                return 0
-        # process objects to the left of index
-        if index - i >= 0:
-            if (reachability_plot[index] < reachability_plot[index - i]):
-                return 0
-    return 1
-
-
-def _find_local_maxima(reachability_plot, reachability_ordering,
-                       neighborhood_size):
-    local_maxima_points = {}
+def _find_local_maxima(reachability_plot, neighborhood_size):
+    # A point is a maximum of its neighborhood if no higher value occurs
+    # within neighborhood_size positions on either side; a single
+    # sliding-window filter checks every point in one pass
+    is_max = (maximum_filter(reachability_plot,
+                             size=2 * neighborhood_size + 1,
+                             mode='constant',
+                             cval=-np.inf) == reachability_plot)
     # 1st and last points on Reachability Plot are not taken
-    # as local maxima points
-    for i in range(1, len(reachability_ordering) - 1):
-        # if the point is a local maxima on the reachability plot with
-        # regard to neighborhood_size, insert it into priority queue and
-        # maxima list
-        if (reachability_plot[i] > reachability_plot[i - 1] and
-            reachability_plot[i] >= reachability_plot[i + 1] and
-            _is_local_maxima(i, reachability_plot, reachability_ordering,
-                             neighborhood_size) == 1):
-            local_maxima_points[i] = reachability_plot[i]
-
-    return sorted(local_maxima_points,
-                  key=local_maxima_points.__getitem__, reverse=True)
+    # as local maxima points; the plot must also rise strictly coming
+    # from the left and not rise going to the right
+    is_max[0] = is_max[-1] = False
+    is_max[1:] &= reachability_plot[1:] > reachability_plot[:-1]
+    is_max[:-1] &= reachability_plot[:-1] >= reachability_plot[1:]
+    maxima = np.flatnonzero(is_max)
+    # Highest reachability first; the stable sort keeps ties in plot
+    # order, matching the former priority queue
+    return maxima[np.argsort(-reachability_plot[maxima], kind='mergesort')]
 
 
 def _cluster_tree(node, parent_node, local_maxima_points,
-                  reachability_plot, reachability_ordering,
-                  min_cluster_size, maxima_ratio, rejection_ratio,
+                  reachability_plot, min_cluster_size,
+                  maxima_ratio, rejection_ratio,
                   similarity_threshold, significant_min):
-    # node is a node or the root of the tree in the first call
-    # parent_node is parent node of N or None if node is root of the tree
-    # local_maxima_points is list of local maxima points sorted in
-    # descending order of reachability
-    if len(local_maxima_points) == 0:
-        return  # parent_node is a leaf
-
-    # take largest local maximum as possible separation between clusters
-    s = local_maxima_points[0]
-    node.assign_split_point(s)
-    local_maxima_points = local_maxima_points[1:]
-
-    # create two new nodes and add to list of nodes
-    node_1 = _TreeNode(reachability_ordering[node.start:s],
-                       node.start, s, node)
-    node_2 = _TreeNode(reachability_ordering[s + 1:node.end],
-                       s + 1, node.end, node)
-    local_max_1 = []
-    local_max_2 = []
-
-    for i in local_maxima_points:
-        if i < s:
-            local_max_1.append(i)
-        if i > s:
-            local_max_2.append(i)
-
-    node_list = []
-    node_list.append((node_1, local_max_1))
-    node_list.append((node_2, local_max_2))
-
-    if reachability_plot[s] < significant_min:
-        node.assign_split_point(-1)
-        # if split_point is not significant, ignore this split and continue
-        _cluster_tree(node, parent_node, local_maxima_points,
-                      reachability_plot, reachability_ordering,
-                      min_cluster_size, maxima_ratio, rejection_ratio,
-                      similarity_threshold, significant_min)
-        return
-
-    # only check a certain ratio of points in the child
-    # nodes formed to the left and right of the maxima
-    # ...should check_ratio be a user settable parameter?
-    check_ratio = .8
-    check_value_1 = int(np.round(check_ratio * len(node_1.points)))
-    check_value_2 = int(np.round(check_ratio * len(node_2.points)))
-    if check_value_2 == 0:
-        check_value_2 = 1
-    avg_reach_value_1 = float(np.average(reachability_plot[(node_1.end -
-                                         check_value_1):node_1.end]))
-    avg_reach_value_2 = float(np.average(reachability_plot[node_2.start:(
-                                node_2.start + check_value_2)]))
-
-    if (float(avg_reach_value_1 / float(reachability_plot[s])) >
-        maxima_ratio or float(avg_reach_value_2 /
-                              float(reachability_plot[s])) > maxima_ratio):
-
-        if float(avg_reach_value_1 /
-                 float(reachability_plot[s])) < rejection_ratio:
-            # reject node 2
-            node_list.remove((node_2, local_max_2))
-        if float(avg_reach_value_2 /
-                 float(reachability_plot[s])) < rejection_ratio:
-            # reject node 1
-            node_list.remove((node_1, local_max_1))
-        if (float(avg_reach_value_1 /
-            float(reachability_plot[s])) >= rejection_ratio and float(
-                avg_reach_value_2 /
-                float(reachability_plot[s])) >= rejection_ratio):
+    # Builds the cluster tree with an explicit stack instead of Python
+    # recursion, so arbitrarily deep trees cannot hit the recursion
+    # limit. Each entry holds a node to split, its parent (None for the
+    # root of the tree), the local maxima points falling inside the node
+    # sorted in descending order of reachability, and the node the entry
+    # must be attached to when it is popped. Attaching on pop keeps the
+    # children lists in the same order the recursive version built them:
+    # a sibling is only added once the subtree before it is finished.
+    stack = [(node, parent_node, local_maxima_points, None)]
+
+    while stack:
+        node, parent_node, local_maxima_points, attach_to = stack.pop()
+        if attach_to is not None:
+            attach_to.add_child(node)
+        if len(local_maxima_points) == 0:
+            continue  # node is a leaf
+
+        # take largest local maximum as possible separation between clusters
+        s = local_maxima_points[0]
+        node.assign_split_point(s)
+        local_maxima_points = local_maxima_points[1:]
+
+        # create two new nodes; the maxima are partitioned around the
+        # split point with boolean masks, which keeps each side in
+        # descending order of reachability
+        node_1 = _TreeNode(node.start, s, node)
+        node_2 = _TreeNode(s + 1, node.end, node)
+        local_max_1 = local_maxima_points[local_maxima_points < s]
+        local_max_2 = local_maxima_points[local_maxima_points > s]
+        keep_1 = True
+        keep_2 = True
+
+        if reachability_plot[s] < significant_min:
+            node.assign_split_point(-1)
+            # if split_point is not significant, ignore this split and
+            # continue with the next largest maximum
+            stack.append((node, parent_node, local_maxima_points, None))
+            continue
+
+        # only check a certain ratio of points in the child
+        # nodes formed to the left and right of the maxima
+        # ...should check_ratio be a user settable parameter?
+        check_ratio = .8
+        size_1 = node_1.end - node_1.start
+        size_2 = node_2.end - node_2.start
+        check_value_1 = int(np.round(check_ratio * size_1))
+        check_value_2 = int(np.round(check_ratio * size_2))
+        if check_value_2 == 0:
+            check_value_2 = 1
+        # Slice averages rather than prefix-sum differences: the plot
+        # holds +inf at every expansion seed, for which running-sum
+        # differences would degenerate to NaN
+        avg_reach_value_1 = float(np.average(reachability_plot[(node_1.end -
+                                             check_value_1):node_1.end]))
+        avg_reach_value_2 = float(np.average(reachability_plot[node_2.start:(
+                                    node_2.start + check_value_2)]))
+        split_reach = float(reachability_plot[s])
+
+        if (avg_reach_value_1 / split_reach > maxima_ratio or
+                avg_reach_value_2 / split_reach > maxima_ratio):
+
+            if avg_reach_value_1 / split_reach < rejection_ratio:
+                # reject node 2
+                keep_2 = False
+            if avg_reach_value_2 / split_reach < rejection_ratio:
+                # reject node 1
+                keep_1 = False
+            if (avg_reach_value_1 / split_reach >= rejection_ratio and
+                    avg_reach_value_2 / split_reach >= rejection_ratio):
+                node.assign_split_point(-1)
+                # since split_point is not significant,
+                # ignore this split and continue (reject both child nodes)
+                stack.append((node, parent_node, local_maxima_points, None))
+                continue
+
+        # remove clusters that are too small
+        if (node_1.end - node_1.start) < min_cluster_size:
+            # cluster 1 is too small
+            keep_1 = False
+        if ((node_2.end - node_2.start) < min_cluster_size and
+                local_max_1.size == 0 and local_max_2.size == 0):
+            # cluster 2 is too small; only discarded once no deeper
+            # maxima remain on either side (the historical behavior of
+            # the list bookkeeping this replaces)
+            keep_2 = False
+
+        node_list = []
+        if keep_1:
+            node_list.append((node_1, local_max_1))
+        if keep_2:
+            node_list.append((node_2, local_max_2))
+        if len(node_list) == 0:
+            # parent_node will be a leaf
             node.assign_split_point(-1)
-            # since split_point is not significant,
-            # ignore this split and continue (reject both child nodes)
-            _cluster_tree(node, parent_node, local_maxima_points,
-                          reachability_plot, reachability_ordering,
-                          min_cluster_size, maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
-            return
-
-    # remove clusters that are too small
-    if (len(node_1.points) < min_cluster_size and
-            node_list.count((node_1, local_max_1)) > 0):
-        # cluster 1 is too small
-        node_list.remove((node_1, local_max_1))
-    if (len(node_2.points) < min_cluster_size and
-            node_list.count((node_2, local_max_1)) > 0):
-        # cluster 2 is too small
-        node_list.remove((node_2, local_max_2))
-    if len(node_list) == 0:
-        # parent_node will be a leaf
-        node.assign_split_point(-1)
-        return
-
-    # Check if nodes can be moved up one level - the new cluster created
-    # is too "similar" to its parent, given the similarity threshold.
-    bypass_node = 0
-    if parent_node is not None:
-        if (float(float(node.end - node.start) /
-                  float(parent_node.end - parent_node.start)) >
-                similarity_threshold):
-
-            parent_node.children.remove(node)
-            bypass_node = 1
-
-    for nl in node_list:
-        if bypass_node == 1:
-            parent_node.add_child(nl[0])
-            _cluster_tree(nl[0], parent_node, nl[1],
-                          reachability_plot, reachability_ordering,
-                          min_cluster_size, maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
-        else:
-            node.add_child(nl[0])
-            _cluster_tree(nl[0], node, nl[1], reachability_plot,
-                          reachability_ordering, min_cluster_size,
-                          maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
+            continue
+
+        # Check if nodes can be moved up one level - the new cluster
+        # created is too "similar" to its parent, given the similarity
+        # threshold.
+        bypass_node = 0
+        if parent_node is not None:
+            if (float(float(node.end - node.start) /
+                      float(parent_node.end - parent_node.start)) >
+                    similarity_threshold):
+
+                parent_node.children.remove(node)
+                bypass_node = 1
+
+        # Pushed in reverse so that the first child is processed (and
+        # attached) first, exactly as the recursive calls did
+        for nl in reversed(node_list):
+            if bypass_node == 1:
+                stack.append((nl[0], parent_node, nl[1], parent_node))
+            else:
+                stack.append((nl[0], node, nl[1], node))
 
 
 def _get_leaves(node, arr):
-    if node is not None:
+    # Iterative pre-order walk, so deep trees cannot hit the recursion
+    # limit; children are pushed in reverse to collect the leaves in the
+    # same left-to-right order the recursive version produced
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
         if node.split_point == -1:
             arr.append(node)
-        for n in node.children:
-            _get_leaves(n, arr)
+        stack.extend(reversed(node.children))
     return arr
@@ -2,13 +2,19 @@
 #          Amy X. Zhang <axz@mit.edu>
 # License: BSD 3 clause
 
+import os
+import shutil
+from tempfile import mkdtemp
+
 import numpy as np
 
 from sklearn.datasets.samples_generator import make_blobs
 from sklearn.cluster.optics_ import OPTICS
 from sklearn.utils.testing import assert_equal, assert_warns
 from sklearn.utils.testing import assert_array_almost_equal
+from sklearn.utils.testing import assert_array_equal
 from sklearn.utils.testing import assert_raises
+from sklearn.utils.testing import assert_true
 
 from sklearn.cluster.tests.common import generate_clustered_data
 
@@ -340,3 +346,51 @@ def test_reach_dists():
          0.446161, 0.629962]
 
     assert_array_almost_equal(clust.reachability_, np.array(v))
+
+
+def test_memory():
+    # Test caching of the neighborhood computation
+    centers = [[1, 1], [-1, -1], [1, -1]]
+    X, labels_true = make_blobs(n_samples=150, centers=centers,
+                                cluster_std=0.4, random_state=0)
+
+    clust = OPTICS(max_bound=1.0, min_samples=10).fit(X)
+    try:
+        tempdir = mkdtemp()
+        cached = OPTICS(max_bound=1.0, min_samples=10, memory=tempdir)
+        cached.fit(X)
+        # the neighborhoods are now on disk ...
+        assert_true(len(os.listdir(tempdir)) > 0)
+        # ... and the second fit is served from the cache
+        cached.fit(X)
+        assert_array_equal(clust.labels_, cached.labels_)
+        assert_array_equal(clust.ordering_, cached.ordering_)
+        assert_array_almost_equal(clust.reachability_, cached.reachability_)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_wrong_arg_memory():
+    # Test either if an error is raised when memory is not
+    # either a str or a joblib.Memory instance
+    X = generate_clustered_data(n_clusters=3)
+    clust = OPTICS(memory=5)
+    assert_raises(ValueError, clust.fit, X)
+
+
+def test_n_jobs():
+    # Parallel neighborhood queries must reproduce the serial results
+    centers = [[1, 1], [-1, -1], [1, -1]]
+    X, labels_true = make_blobs(n_samples=150, centers=centers,
+                                cluster_std=0.4, random_state=0)
+
+    # both the chunked tree queries and the brute-force path
+    for algorithm in ['ball_tree', 'brute']:
+        serial = OPTICS(max_bound=1.0, min_samples=10,
+                        algorithm=algorithm).fit(X)
+        parallel = OPTICS(max_bound=1.0, min_samples=10,
+                          algorithm=algorithm, n_jobs=2).fit(X)
+        assert_array_equal(serial.labels_, parallel.labels_)
+        assert_array_equal(serial.ordering_, parallel.ordering_)
+        assert_array_almost_equal(serial.reachability_,
+                                  parallel.reachability_)